@@ -0,0 +1 @@
+"""Root conftest: its presence puts the repository root on sys.path, so tests can import the app modules."""
@@ -1,33 +1,52 @@
 from dotenv import load_dotenv
 import streamlit as st
-import asyncio
-import os
-from typing import List
-
-# Import all the message part classes
-from pydantic_ai.messages import (
-    ModelMessage,
-    ModelRequest,
-    ModelResponse,
-    SystemPromptPart,
-    UserPromptPart,
-    TextPart,
-    ToolCallPart,
-    ToolReturnPart,
-    RetryPromptPart,
-    ModelMessagesTypeAdapter
-)
+from collections import deque
+from itertools import groupby, islice
+from typing import List, Tuple
+
+# Import the message classes used for isinstance checks
+from pydantic_ai.messages import ModelRequest, ModelResponse
 
 from rag_agent import agent, RAGDeps
 from utils import get_chroma_client
 
-load_dotenv()
+__all__ = [
+    "MAX_MESSAGES",
+    "MAX_TOKENS_ESTIMATE",
+    "estimate_message_tokens",
+    "limit_message_history",
+    "clear_chat_history",
+    "display_message_parts",
+    "validate_message_history",
+    "finalize_turn",
+    "run_agent_with_streaming",
+    "main",
+]
 
 # Message management configuration
 MAX_MESSAGES = 10  # Maximum number of messages to keep in history
 MAX_TOKENS_ESTIMATE = 4000  # Rough estimate of token limit for context
 
-async def get_agent_deps():
+# Integer ids for part kinds, stored on each part as _kind_id when it enters the history
+_KIND_USER_PROMPT, _KIND_TEXT, _KIND_TOOL_CALL, _KIND_TOOL_RETURN, _KIND_OTHER = range(5)
+_KIND = {
+    'user-prompt': _KIND_USER_PROMPT,
+    'text': _KIND_TEXT,
+    'tool-call': _KIND_TOOL_CALL,
+    'tool-return': _KIND_TOOL_RETURN,
+}
+
+
+@st.cache_resource
+def _load_env():
+    """Load environment variables from .env once per process."""
+    # Redundant in practice: importing rag_agent already loads .env and exits if settings are missing
+    load_dotenv()
+
+
+@st.cache_resource
+def _build_deps():
+    """Build the agent dependencies once per process and share them across sessions."""
     return RAGDeps(
         chroma_client=get_chroma_client("./chroma_db"),
         collection_name="docs",
@@ -35,131 +54,234 @@ async def get_agent_deps():
     )
 
 
-def estimate_message_tokens(messages: List) -> int:
-    """Rough estimation of tokens in message history."""
+def _count_message_chars(msg) -> int:
+    """
+    Count the characters of string content in a single message.
+    Tool returns are skipped: they dominate the payload size but are not
+    part of the visible conversation.
+    """
     total_chars = 0
-    for msg in messages:
-        if isinstance(msg, (ModelRequest, ModelResponse)):
-            for part in msg.parts:
-                if hasattr(part, 'content'):
-                    total_chars += len(str(part.content))
+    for part in msg.parts:
+        if part._kind_id == _KIND_TOOL_RETURN:
+            continue
+        content = getattr(part, 'content', None)
+        if isinstance(content, str):
+            total_chars += len(content)
+    return total_chars
+
+
+def _evict_validated(evicted):
+    """
+    Drop an evicted message from the head of the validated view.
+    The view is marked stale, since tool returns kept in it may have relied
+    on the evicted message's tool calls.
+    """
+    view = st.session_state.validated_view
+    if view and view[0] is evicted:
+        del view[0]
+        st.session_state.validated_stale = True
+
+
+def _append_message(msg):
+    """
+    Append a message to the bounded history and keep the character counter in sync.
+    When the deque is full, the oldest message is evicted and its cached count subtracted.
+    Only ModelRequest and ModelResponse messages are kept, so readers of the
+    history never need to check message types.
+    """
+    if not isinstance(msg, (ModelRequest, ModelResponse)):
+        return
+    for part in msg.parts:
+        part._kind_id = _KIND.get(part.part_kind, _KIND_OTHER)
+    
+    messages = st.session_state.messages
+    if len(messages) == messages.maxlen:
+        evicted = messages[0]
+        st.session_state.total_chars -= st.session_state.message_chars.pop(id(evicted), 0)
+        if st.session_state.validated_len:
+            st.session_state.validated_len -= 1
+            _evict_validated(evicted)
+    
+    chars = _count_message_chars(msg)
+    st.session_state.message_chars[id(msg)] = chars
+    st.session_state.total_chars += chars
+    messages.append(msg)
+
+
+def estimate_message_tokens() -> int:
+    """Rough estimation of tokens in message history."""
     # Rough estimate: 4 characters per token
-    return total_chars // 4
+    return st.session_state.total_chars >> 2
 
 
-def limit_message_history(messages: List, max_messages: int = None) -> List:
+def limit_message_history(messages, max_messages: int = None) -> deque:
     """
-    Limit message history to the last N messages while preserving pairs.
-    Simple truncation - validation happens separately.
+    Rebuild the message history as a deque bounded to the last N messages.
+    The character counter is recomputed in the same pass and the validated view is reset.
     """
     if max_messages is None:
         max_messages = st.session_state.get('custom_max_messages', MAX_MESSAGES)
-        
-    if len(messages) <= max_messages:
-        return messages
     
-    # Simple truncation from the end
-    return messages[-max_messages:]
+    st.session_state.messages = deque(maxlen=max_messages)
+    st.session_state.message_chars = {}
+    st.session_state.total_chars = 0
+    st.session_state.validated_view = []
+    st.session_state.validated_len = 0
+    st.session_state.validated_stale = False
+    st.session_state.pending_tool_calls = 0
+    for msg in messages:
+        _append_message(msg)
+    return st.session_state.messages
 
 
 def clear_chat_history():
     """Clear the chat history from session state, but preserve complete tool sequences."""
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-        st.rerun()
-        return
-    
     # Don't preserve any tool messages to avoid sequence issues
     # Tool calls must be followed by tool returns in proper sequence
     # Clearing all messages ensures we start fresh without orphaned tool messages
-    st.session_state.messages = []
+    limit_message_history([])
     st.rerun()
 
 
-def display_message_part(part):
+def _render_noop(part):
+    pass
+
+
+def _render_markdown(part):
+    st.markdown(part.content)
+
+
+def _render_tool_call(part):
+    with st.expander(f"🔧 Tool Call: {part.tool_name}", expanded=False):
+        st.code(str(part.args), language="json")
+
+
+def _render_tool_return(part):
+    with st.expander(f"📋 Tool Result: {part.tool_name}", expanded=False):
+        st.text(str(part.content))
+
+
+# Renderers indexed by _kind_id; each runs inside the matching st.chat_message context
+_PART_RENDERERS = (
+    _render_markdown,  # _KIND_USER_PROMPT
+    _render_markdown,  # _KIND_TEXT
+    _render_tool_call,  # _KIND_TOOL_CALL
+    _render_tool_return,  # _KIND_TOOL_RETURN
+    _render_noop,  # _KIND_OTHER
+)
+
+
+def _part_role(part) -> str:
+    return "user" if part._kind_id == _KIND_USER_PROMPT else "assistant"
+
+
+def display_message_parts(parts):
     """
-    Display a single part of a message in the Streamlit UI.
-    Customize how you display system prompts, user prompts,
-    tool calls, tool returns, etc.
+    Display message parts in the Streamlit UI.
+    Consecutive parts from the same role share a single chat message,
+    and parts without a renderer (system prompts, retries) are skipped.
     """
-    # user-prompt
-    if part.part_kind == 'user-prompt':
-        with st.chat_message("user"):
-            st.markdown(part.content)
-    # text
-    elif part.part_kind == 'text':
-        with st.chat_message("assistant"):
-            st.markdown(part.content)
-    # tool-call
-    elif part.part_kind == 'tool-call':
-        with st.chat_message("assistant"):
-            with st.expander(f"🔧 Tool Call: {part.tool_name}", expanded=False):
-                st.code(str(part.args), language="json")
-    # tool-return  
-    elif part.part_kind == 'tool-return':
-        with st.chat_message("assistant"):
-            with st.expander(f"📋 Tool Result: {part.tool_name}", expanded=False):
-                st.text(str(part.content))             
+    renderable = (part for part in parts if part._kind_id != _KIND_OTHER)
+    for role, group in groupby(renderable, key=_part_role):
+        with st.chat_message(role):
+            for part in group:
+                _PART_RENDERERS[part._kind_id](part)
+
 
-def validate_message_history(messages: List) -> List:
+def _classify_parts(msg) -> Tuple[int, int, bool]:
+    """Count the tool calls and tool returns in a message and flag any other parts."""
+    tool_calls = 0
+    tool_returns = 0
+    has_other = False
+    for part in msg.parts:
+        kind_id = part._kind_id
+        if kind_id == _KIND_TOOL_CALL:
+            tool_calls += 1
+        elif kind_id == _KIND_TOOL_RETURN:
+            tool_returns += 1
+        else:
+            has_other = True
+    return tool_calls, tool_returns, has_other
+
+
+def validate_message_history(messages, pending_tool_calls: int = 0) -> Tuple[List, int]:
     """
     Validate and clean message history to ensure proper tool call sequences.
     Remove any orphaned tool messages that could cause API errors.
+    Returns the kept messages and the number of tool calls still pending, so
+    validation can resume on messages appended later.
     """
-    if not messages:
-        return messages
-    
     validated_messages = []
-    tool_calls_stack = []  # Track pending tool calls
     
     for msg in messages:
-        if isinstance(msg, (ModelRequest, ModelResponse)):
-            msg_tool_calls = []
-            msg_tool_returns = []
-            other_parts = []
-            
-            # Categorize parts in this message
-            for part in msg.parts:
-                if isinstance(part, ToolCallPart):
-                    msg_tool_calls.append(part)
-                elif isinstance(part, ToolReturnPart):
-                    msg_tool_returns.append(part)
-                else:
-                    other_parts.append(part)
-            
-            # Handle tool calls - add to stack
-            if msg_tool_calls:
-                tool_calls_stack.extend(msg_tool_calls)
-                # Keep the message with tool calls
-                validated_messages.append(msg)
-            
-            # Handle tool returns
-            elif msg_tool_returns:
-                # Only keep tool returns if we have pending tool calls
-                if tool_calls_stack:
-                    # Remove corresponding tool calls from stack
-                    for _ in msg_tool_returns:
-                        if tool_calls_stack:
-                            tool_calls_stack.pop(0)
-                    validated_messages.append(msg)
-                # Skip orphaned tool returns
-            
-            # Handle regular messages (no tool parts)
-            elif other_parts:
+        # Categorize parts in this message in a single pass
+        tool_calls, tool_returns, has_other = _classify_parts(msg)
+        
+        # Handle tool calls - keep the message and count them as pending
+        if tool_calls:
+            pending_tool_calls += tool_calls
+            validated_messages.append(msg)
+        
+        # Handle tool returns
+        elif tool_returns:
+            # Only keep tool returns if we have pending tool calls
+            if pending_tool_calls:
+                pending_tool_calls -= min(pending_tool_calls, tool_returns)
                 validated_messages.append(msg)
+            # Skip orphaned tool returns
+        
+        # Handle regular messages (no tool parts)
+        elif has_other:
+            validated_messages.append(msg)
     
-    return validated_messages
+    return validated_messages, pending_tool_calls
 
-async def run_agent_with_streaming(user_input):
-    # Limit message history before passing to agent
-    limited_messages = limit_message_history(st.session_state.messages)
+
+def finalize_turn():
+    """Add the messages from the last finished run to the chat history."""
+    new_messages = st.session_state.get("pending_new_messages")
+    if new_messages is None:
+        return
+    st.session_state.pending_new_messages = None
     
-    # Validate message history to prevent tool sequence errors
-    validated_messages = validate_message_history(limited_messages)
+    # Add the new messages to the chat history (including tool calls and responses)
+    # The bounded deque evicts the oldest messages as new ones arrive
+    for msg in new_messages:
+        _append_message(msg)
+
+
+def _validated_history() -> List:
+    """
+    Return the validated message history, validating only what changed since the last call.
+    Messages validated on earlier turns are kept in validated_view, so normally only
+    the newly appended tail is processed. After an eviction the view is revalidated
+    from scratch first, so pending tool calls from evicted messages do not carry over.
+    """
+    if st.session_state.validated_stale:
+        st.session_state.validated_view, st.session_state.pending_tool_calls = (
+            validate_message_history(st.session_state.validated_view)
+        )
+        st.session_state.validated_stale = False
+    
+    messages = st.session_state.messages
+    new_messages = islice(messages, st.session_state.validated_len, None)
+    validated_tail, st.session_state.pending_tool_calls = validate_message_history(
+        new_messages, st.session_state.pending_tool_calls
+    )
+    st.session_state.validated_view.extend(validated_tail)
+    st.session_state.validated_len = len(messages)
+    return st.session_state.validated_view
+
+
+async def run_agent_with_streaming(user_input):
+    # The history deque is already bounded, so only validation is needed here
+    # to prevent tool sequence errors.
+    # agent.run_stream copies message_history before the run, so the view is
+    # passed as-is instead of being copied here on every turn
+    validated_messages = _validated_history()
     
     # Debug logging
     # print(f"Original messages: {len(st.session_state.messages)}")
-    # print(f"Limited messages: {len(limited_messages)}")
     # print(f"Validated messages: {len(validated_messages)}")
     
     async with agent.run_stream(
@@ -168,11 +290,10 @@ async def run_agent_with_streaming(user_input):
         async for message in result.stream_text(delta=True):  
             yield message
 
-    # Add the new messages to the chat history (including tool calls and responses)
-    st.session_state.messages.extend(result.new_messages())
-    
-    # Apply message limiting after adding new messages
-    st.session_state.messages = limit_message_history(st.session_state.messages)
+    # Only hand the new messages over here; main() adds them to the history
+    # with finalize_turn() once the final response has been rendered, or at the
+    # start of the next run if this one was interrupted by a rerun.
+    st.session_state.pending_new_messages = result.new_messages()
 
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -181,18 +302,33 @@ async def run_agent_with_streaming(user_input):
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-async def main():
+def main():
+    _load_env()
     st.title("DocuBot AI")
 
+    # Initialize chat history in session state if not present
+    if "custom_max_messages" not in st.session_state:
+        st.session_state.custom_max_messages = MAX_MESSAGES
+    if "messages" not in st.session_state:
+        limit_message_history([])
+    if "agent_deps" not in st.session_state:
+        st.session_state.agent_deps = _build_deps()
+
+    # Pick up a finished turn whose run was interrupted (e.g. by a rerun from the
+    # sidebar) before it reached the finalize_turn() call below
+    finalize_turn()
+
     # Sidebar for conversation management
     with st.sidebar:
         st.header("💬 Conversation Management")
         
         # Display conversation metrics
-        message_count = len(st.session_state.get('messages', []))
-        estimated_tokens = estimate_message_tokens(st.session_state.get('messages', []))
-        current_limit = st.session_state.get('custom_max_messages', MAX_MESSAGES)
+        message_count = len(st.session_state.messages)
+        estimated_tokens = estimate_message_tokens()
+        current_limit = st.session_state.custom_max_messages
         
+        # These widgets are emitted on every run even when the values are unchanged:
+        # Streamlit removes elements a rerun does not emit again
         col1, col2 = st.columns(2)
         with col1:
             st.metric("Messages", f"{message_count}/{current_limit}")
@@ -220,9 +356,6 @@ async def main():
         st.header("⚙️ Settings")
         
         # Customizable message limit
-        if "custom_max_messages" not in st.session_state:
-            st.session_state.custom_max_messages = MAX_MESSAGES
-            
         new_limit = st.slider(
             "Max Messages to Keep",
             min_value=3,
@@ -235,9 +368,7 @@ async def main():
         if new_limit != st.session_state.custom_max_messages:
             st.session_state.custom_max_messages = new_limit
             # Apply new limit immediately
-            st.session_state.messages = limit_message_history(
-                st.session_state.messages, new_limit
-            )
+            limit_message_history(st.session_state.messages, new_limit)
             st.rerun()
         
         st.write("**Features:**")
@@ -265,19 +396,11 @@ async def main():
             - Watch the progress bar
             """)
 
-    # Initialize chat history in session state if not present
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if "agent_deps" not in st.session_state:
-        st.session_state.agent_deps = await get_agent_deps()  
-
     # Display all messages from the conversation so far
-    # Each message is either a ModelRequest or ModelResponse.
+    # The history deque is capped at custom_max_messages, so this is already bounded.
+    # Each message is either a ModelRequest or ModelResponse (filtered on append).
     # We iterate over their parts to decide how to display them.
-    for msg in st.session_state.messages:
-        if isinstance(msg, ModelRequest) or isinstance(msg, ModelResponse):
-            for part in msg.parts:
-                display_message_part(part)
+    display_message_parts(part for msg in st.session_state.messages for part in msg.parts)
 
     # Chat input for the user
     user_input = st.chat_input("What do you want to know?")
@@ -289,19 +412,14 @@ async def main():
 
         # Display the assistant's partial response while streaming
         with st.chat_message("assistant"):
-            # Create a placeholder for the streaming text
-            message_placeholder = st.empty()
-            full_response = ""
-            
-            # Properly consume the async generator with async for
-            generator = run_agent_with_streaming(user_input)
-            async for message in generator:
-                full_response += message
-                message_placeholder.markdown(full_response + "▌")
-            
-            # Final response without the cursor
-            message_placeholder.markdown(full_response)
+            # st.write_stream batches the deltas and renders the final text itself.
+            # It drives the async generator on its own event loop, which is why
+            # main() is synchronous. Its container is not cached in session state:
+            # Streamlit elements belong to the script run that created them.
+            st.write_stream(run_agent_with_streaming(user_input))
+
+        finalize_turn()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""Tests for the chat history bookkeeping in streamlit_app."""
+
+import os
+import random
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("pydantic_ai")
+pytest.importorskip("chromadb")
+
+# rag_agent exits at import time without Azure OpenAI settings
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "test")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://example.invalid/")
+os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-02-01")
+
+from pydantic_ai.messages import (
+    ModelRequest,
+    ModelResponse,
+    RetryPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+import streamlit_app as app
+
+
+class _SessionState(dict):
+    """Attribute-access dict standing in for st.session_state outside a script run."""
+
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+@pytest.fixture
+def session_state(monkeypatch):
+    state = _SessionState()
+    monkeypatch.setattr(app.st, "session_state", state)
+    return state
+
+
+def _tool_round(n_calls, retry=False):
+    """A model response with tool calls followed by their returns, or by a retry prompt."""
+    call = ModelResponse(parts=[ToolCallPart(tool_name="retrieve", args="{}") for _ in range(n_calls)])
+    if retry:
+        return [call, ModelRequest(parts=[RetryPromptPart(content="invalid args", tool_name="retrieve")])]
+    returns = ModelRequest(
+        parts=[
+            ToolReturnPart(tool_name="retrieve", content="docs", tool_call_id=part.tool_call_id)
+            for part in call.parts
+        ]
+    )
+    return [call, returns]
+
+
+def _turn(rng):
+    messages = [ModelRequest(parts=[UserPromptPart(content="question")])]
+    for _ in range(rng.randint(0, 4)):
+        messages.extend(_tool_round(rng.randint(1, 3), retry=rng.random() < 0.3))
+    messages.append(ModelResponse(parts=[TextPart(content="answer")]))
+    return messages
+
+
+def _assert_matches_full_validation(state):
+    incremental = list(app._validated_history())
+    full, _ = app.validate_message_history(list(state.messages))
+    assert [id(msg) for msg in incremental] == [id(msg) for msg in full]
+
+
+def test_retry_turn_does_not_leak_pending_tool_calls(session_state):
+    session_state.custom_max_messages = 8
+    app.limit_message_history([])
+
+    first_turn = [ModelRequest(parts=[UserPromptPart(content="question")])]
+    first_turn += _tool_round(1, retry=True) + _tool_round(1)
+    first_turn.append(ModelResponse(parts=[TextPart(content="answer")]))
+    for msg in first_turn:
+        app._append_message(msg)
+    _assert_matches_full_validation(session_state)
+
+    second_turn = [ModelRequest(parts=[UserPromptPart(content="question")])]
+    for _ in range(4):
+        second_turn += _tool_round(1)
+    second_turn.append(ModelResponse(parts=[TextPart(content="answer")]))
+    for msg in second_turn:
+        app._append_message(msg)
+
+    validated = app._validated_history()
+    assert validated[0].parts[0].part_kind != "tool-return"
+    _assert_matches_full_validation(session_state)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_incremental_validation_matches_full_revalidation(session_state, seed):
+    rng = random.Random(seed)
+    session_state.custom_max_messages = rng.choice([3, 8, 13, 18])
+    app.limit_message_history([])
+
+    for _ in range(12):
+        _assert_matches_full_validation(session_state)
+        if rng.random() < 0.1:
+            app.limit_message_history(list(session_state.messages), rng.choice([3, 8, 13, 18]))
+        for msg in _turn(rng):
+            app._append_message(msg)
+    _assert_matches_full_validation(session_state)